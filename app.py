@@ -1,24 +1,23 @@
-from flask import Flask, request, jsonify
-from flask_cors import CORS
-import uuid
+# Card generation routes, registered on the main app in app1.py
+from flask import Blueprint
+import os
+from helpers import json_body, ojsonify
 
-app = Flask(__name__)
-CORS(app)
+card_bp = Blueprint("card", __name__)
 
-# Add root route for GET requests
+# Scheme pricing tables, built once at import instead of per request
+_FEE = {"Silver": 250, "Gold": 500, "Platinum": 1000}
+_DISC = {"Silver": "5%", "Gold": "10%", "Platinum": "15%"}
 
-@app.route("/", methods=["GET"])
-def index():
-    return jsonify({"status": "ok", "message": "Patient Scheme API running"})
 
-@app.route("/generate-card", methods=["POST"])
+@card_bp.route("/generate-card", methods=["POST"])
 def generate_card():
     """
     Endpoint to generate a utility card with scheme logic.
     Input: JSON { "family_name": "", "address": "", "income": 0, "scheme": "Silver/Gold/Platinum" }
     Output: JSON with card details
     """
-    data = request.json
+    data = json_body()
     income = data.get("income", 0)
 
     # Business logic: assign scheme
@@ -27,10 +26,12 @@ def generate_card():
         fee = 0
     else:
         scheme = data.get("scheme", "Silver")
-        fee = {"Silver": 250, "Gold": 500, "Platinum": 1000}[scheme]
+        fee = _FEE.get(scheme) if isinstance(scheme, str) else None
+        if fee is None:
+            return ojsonify({"error": "scheme must be one of Silver, Gold, Platinum"}, 400)
 
     # Generate unique card number
-    card_number = str(uuid.uuid4())[:8]
+    card_number = os.urandom(4).hex()
 
     result = {
         "family_name": data.get("family_name"),
@@ -39,10 +40,8 @@ def generate_card():
         "scheme": scheme,
         "fee": fee,
         "card_number": card_number,
-        "discount": {"Silver": "5%", "Gold": "10%", "Platinum": "15%"}[scheme]
+        "discount": _DISC[scheme]
     }
 
-    return jsonify(result)
+    return ojsonify(result)
 
-if __name__ == "__main__":
-    app.run(debug=True)
@@ -1,14 +1,24 @@
 # app.py
-import os
-from flask import Flask, request, jsonify
+from flask import Flask, request
 from flask_cors import CORS
-from dotenv import load_dotenv
+import orjson
+import config
 import utils
-
-load_dotenv()
+from app import card_bp
+from helpers import json_body, ojsonify
 
 app = Flask(__name__)
+# must be set before routes are added: rules copy these Map defaults when bound.
+# no trailing-slash redirects (saves a 308 round-trip) and no slash-merging pass
+app.url_map.strict_slashes = False
+app.url_map.merge_slashes = False
 CORS(app)  # enable CORS for Lovable frontends (adjust origins in production)
+app.register_blueprint(card_bp)  # /generate-card
+
+
+@app.errorhandler(orjson.JSONDecodeError)
+def _invalid_json(e):
+    return ojsonify({"error": "invalid JSON body"}, 400)
 
 
 def _get_bearer_token():
@@ -27,66 +37,55 @@ def require_auth():
     if not token:
         return None, ("Missing Authorization Bearer token", 401)
     user_parsed = utils.get_user_from_token(token)
-    if user_parsed.get("error"):
+    if user_parsed.get("error") is not None:
         return None, (user_parsed["error"], 401)
-    # user_parsed['data'] may be { 'user': {...} } depending on the SDK
-    data = user_parsed.get("data")
-    if isinstance(data, dict) and data.get("user"):
-        user = data["user"]
-    else:
-        # sometimes get_user returns {'id':..., ...} under data directly; try common shapes:
-        user = data if isinstance(data, dict) else None
-
-    if not user:
-        return None, ("Invalid token / could not resolve user", 401)
-    user_id = user.get("id") or user.get("user", {}).get("id")
-    if not user_id:
-        # fallback: try data['id']
-        user_id = data.get("id") if isinstance(data, dict) else None
-    if not user_id:
-        return None, ("Unable to determine user id", 401)
+    # get_user_from_token always resolves to {'data': {'user': {'id': ...}}}
+    try:
+        user_id = user_parsed["data"]["user"]["id"]
+    except (KeyError, TypeError):
+        return None, ("Invalid token", 401)
     return user_id, None
 
 
 @app.route("/", methods=["GET"])
 def index():
-    return jsonify({"status": "ok", "message": "Patient Scheme API running"})
+    return ojsonify({"status": "ok", "message": "Patient Scheme API running"})
 
 
 # AUTH routes ------------------------------------------------
 
 @app.route("/register", methods=["POST"])
 def register():
-    body = request.get_json(force=True)
+    body = json_body()
     email = body.get("email")
     password = body.get("password")
     name = body.get("name")
     if not email or not password:
-        return jsonify({"error": "email & password required"}), 400
+        return ojsonify({"error": "email & password required"}, 400)
     resp = utils.register_user(email, password, user_metadata={"name": name} if name else None)
-    return jsonify(resp)
+    return ojsonify(resp)
 
 
 @app.route("/login", methods=["POST"])
 def login():
-    body = request.get_json(force=True)
+    body = json_body()
     email = body.get("email")
     password = body.get("password")
     if not email or not password:
-        return jsonify({"error": "email & password required"}), 400
+        return ojsonify({"error": "email & password required"}, 400)
     resp = utils.login_user(email, password)
-    return jsonify(resp)
+    return ojsonify(resp)
 
 
 @app.route("/forgot-password", methods=["POST"])
 def forgot_password():
-    body = request.get_json(force=True)
+    body = json_body()
     email = body.get("email")
     redirect_to = body.get("redirect_to")  # optional
     if not email:
-        return jsonify({"error": "email required"}), 400
+        return ojsonify({"error": "email required"}, 400)
     resp = utils.send_password_reset(email, redirect_to)
-    return jsonify(resp)
+    return ojsonify(resp)
 
 
 # FAMILY endpoints (protected) --------------------------------
@@ -95,62 +94,117 @@ def forgot_password():
 def create_family():
     user_id, err = require_auth()
     if err:
-        return jsonify({"error": err[0]}), err[1]
-    body = request.get_json(force=True)
-    family_name = body.get("family_name")
-    address = body.get("address", "")
-    annual_income = int(body.get("annual_income", 0))
-    members = body.get("members", [])  # list of {name, relation, age}
-    chosen_scheme = body.get("chosen_scheme")
+        return ojsonify({"error": err[0]}, err[1])
+    body = json_body()
+    # pull the scalar fields we need up front and reject early, before touching members
+    get = body.get
+    family_name = get("family_name")
     if not family_name:
-        return jsonify({"error": "family_name required"}), 400
+        return ojsonify({"error": "family_name required"}, 400)
+    try:
+        annual_income = int(get("annual_income", 0))
+    except (TypeError, ValueError):
+        return ojsonify({"error": "annual_income must be an integer"}, 400)
+    address = get("address", "")
+    chosen_scheme = get("chosen_scheme")
+    members = get("members") or []  # list of {name, relation, age}
 
     res = utils.create_family(user_id, family_name, address, annual_income, members, chosen_scheme)
-    if res.get("error"):
-        return jsonify({"error": res["error"]}), 400
-    return jsonify(res)
+    if res.get("error") is not None:
+        return ojsonify({"error": res["error"]}, res.get("status", 400))
+    return ojsonify(res)
+
+
+def _wrap_families(chunks):
+    """Wrap a streamed JSON array in the usual {"data": ..., "error": null} envelope."""
+    try:
+        yield b'{"data":'
+        yield from chunks
+        yield b',"error":null}'
+    finally:
+        chunks.close()
 
 
 @app.route("/families", methods=["GET"])
 def get_families():
     user_id, err = require_auth()
     if err:
-        return jsonify({"error": err[0]}), err[1]
+        return ojsonify({"error": err[0]}, err[1])
     res = utils.get_families_for_user(user_id)
-    return jsonify(res)
+    if res.get("error") is not None:
+        # upstream (PostgREST / Postgres) failure, not a client mistake
+        return ojsonify({"error": res["error"]}, 502)
+    # splice the pre-encoded array in rather than parsing and re-serializing it
+    if "stream" in res:
+        # no Content-Length: the body goes out chunked as PostgREST produces it
+        response = app.response_class(_wrap_families(res["stream"]), mimetype="application/json")
+        response.call_on_close(res["close"])
+        return response
+    return app.response_class(b'{"data":' + res["data"] + b',"error":null}', mimetype="application/json")
 
 
 @app.route("/family/<int:family_id>", methods=["PUT"])
 def update_family(family_id):
     user_id, err = require_auth()
     if err:
-        return jsonify({"error": err[0]}), err[1]
-    updates = request.get_json(force=True)
+        return ojsonify({"error": err[0]}, err[1])
+    updates = json_body()
     # optional: ensure the family belongs to user (additional security check)
     # implement a check if needed
-    res = utils.update_family(family_id, updates)
-    return jsonify(res)
+    res = utils.update_family(user_id, family_id, updates)
+    return ojsonify(res)
 
 
 @app.route("/member/<int:member_id>", methods=["PUT"])
 def update_member(member_id):
     user_id, err = require_auth()
     if err:
-        return jsonify({"error": err[0]}), err[1]
-    updates = request.get_json(force=True)
-    res = utils.update_member(member_id, updates)
-    return jsonify(res)
+        return ojsonify({"error": err[0]}, err[1])
+    updates = json_body()
+    res = utils.update_member(user_id, member_id, updates)
+    return ojsonify(res)
+
+
+# editable member columns and their JSON types; null leaves the column unchanged
+_MEMBER_FIELDS = {"name": str, "relation": str, "age": int}
+
+
+def _valid_member_update(item):
+    if not isinstance(item, dict) or type(item.get("id")) is not int:
+        return False
+    updates = item.get("updates", {})
+    return isinstance(updates, dict) and all(
+        k in _MEMBER_FIELDS and (v is None or type(v) is _MEMBER_FIELDS[k]) for k, v in updates.items()
+    )
+
+
+@app.route("/members/bulk", methods=["PUT"])
+def bulk_update_members():
+    user_id, err = require_auth()
+    if err:
+        return ojsonify({"error": err[0]}, err[1])
+    items = json_body(list)  # list of {id, updates}
+    if not all(_valid_member_update(i) for i in items):
+        return ojsonify({"error": "expected a list of {id: int, updates: {name?, relation?, age?}}"}, 400)
+    res = utils.bulk_update_members(user_id, items)
+    if res.get("error") is not None:
+        return ojsonify({"error": res["error"]}, res.get("status", 400))
+    return ojsonify(res)
 
 
 @app.route("/member/<int:member_id>", methods=["DELETE"])
 def remove_member(member_id):
     user_id, err = require_auth()
     if err:
-        return jsonify({"error": err[0]}), err[1]
-    res = utils.delete_member(member_id)
-    return jsonify(res)
+        return ojsonify({"error": err[0]}, err[1])
+    res = utils.delete_member(user_id, member_id)
+    return ojsonify(res)
+
+
+# compile the URL matcher at import (before gunicorn forks) instead of on the first request
+app.url_map.update()
 
 
 if __name__ == "__main__":
-    # run with: python app.py
-    app.run(host="0.0.0.0", port=int(os.getenv("PORT", 5000)), debug=True)
+    # dev only: python app1.py  (production: gunicorn -c gunicorn_conf.py app1:app)
+    app.run(host="0.0.0.0", port=config.PORT, debug=True)
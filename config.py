@@ -0,0 +1,17 @@
+# config.py
+# Loads .env once and exposes validated settings; import this instead of calling load_dotenv().
+import os
+from dotenv import load_dotenv
+
+load_dotenv()  # read .env
+
+SUPABASE_URL = os.getenv("SUPABASE_URL") or ""
+SUPABASE_SERVICE_ROLE_KEY = os.getenv("SUPABASE_SERVICE_ROLE_KEY") or ""
+
+# Optional direct Postgres DSN; enables COPY for large member lists and direct /families reads
+DATABASE_URL = os.getenv("DATABASE_URL")
+
+PORT = int(os.getenv("PORT", 5000))
+
+if not SUPABASE_URL or not SUPABASE_SERVICE_ROLE_KEY:
+    raise RuntimeError("Set SUPABASE_URL and SUPABASE_SERVICE_ROLE_KEY in your .env")
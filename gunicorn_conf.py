@@ -0,0 +1,14 @@
+# gunicorn_conf.py
+# Production server for the API (the Werkzeug dev server has no keep-alive):
+#   gunicorn -c gunicorn_conf.py app1:app
+import multiprocessing
+import os
+from config import PORT  # loads .env, same as the app
+
+bind = f"0.0.0.0:{PORT}"
+workers = int(os.getenv("WEB_CONCURRENCY", multiprocessing.cpu_count() * 2 + 1))
+worker_class = "gthread"
+threads = 8
+keepalive = 30  # seconds to hold idle client connections open for reuse
+max_requests = 10000
+max_requests_jitter = 500  # stagger worker recycling
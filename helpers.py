@@ -0,0 +1,23 @@
+# helpers.py
+# Shared request/response helpers for the API routes (app1.py and the blueprints it registers).
+from flask import Response, abort, request
+import orjson
+
+
+def ojsonify(obj, status=200):
+    """Serialize obj with orjson and wrap it in a JSON response."""
+    return Response(orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS),
+                    status=status, mimetype="application/json")
+
+
+def json_body(expected=dict):
+    """Parse the raw request body with orjson, skipping Flask's get_json plumbing.
+
+    Malformed JSON raises orjson.JSONDecodeError, turned into a 400 by the app's error handler;
+    valid JSON of the wrong type (object by default, pass list for array bodies) aborts with a 400.
+    """
+    body = orjson.loads(request.get_data(cache=False) or (b"{}" if expected is dict else b"[]"))
+    if not isinstance(body, expected):
+        kind = "an object" if expected is dict else "an array"
+        abort(ojsonify({"error": f"JSON body must be {kind}"}, 400))
+    return body
@@ -0,0 +1,12 @@
+# setup.py
+# Optional AOT build: compiles utils.py to a C extension with mypyc.
+#   pip install mypy && python setup.py build_ext --inplace
+# The resulting utils.*.so sits next to utils.py and is imported in its place
+# (delete it to go back to the interpreted module).
+from setuptools import setup
+from mypyc.build import mypycify
+
+setup(
+    name="patient-scheme",
+    ext_modules=mypycify(["utils.py"]),
+)
@@ -0,0 +1,23 @@
+-- Applies many member edits in one round-trip / one UPDATE statement.
+-- payload: [{"id": 1, "name": "...", "relation": "...", "age": 30}, ...]; omitted fields are left unchanged.
+-- Only rows belonging to p_user's families are touched; other ids are silently skipped.
+-- Called from utils.bulk_update_members via supabase.rpc("bulk_update_members", ...).
+drop function if exists public.bulk_update_members(jsonb);
+
+create or replace function public.bulk_update_members(p_user uuid, payload jsonb)
+returns setof family_members
+language sql
+as $$
+    update family_members fm
+    set name = coalesce(p.name, fm.name),
+        relation = coalesce(p.relation, fm.relation),
+        age = coalesce(p.age, fm.age)
+    from jsonb_to_recordset(payload) as p(id bigint, name text, relation text, age int)
+    where fm.id = p.id
+      and fm.family_id in (select id from families where user_id = p_user)
+    returning fm.*;
+$$;
+
+-- server-side only: keep PostgREST from exposing it to anon/authenticated API keys
+revoke execute on function public.bulk_update_members(uuid, jsonb) from public, anon, authenticated;
+grant execute on function public.bulk_update_members(uuid, jsonb) to service_role;
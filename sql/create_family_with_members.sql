@@ -0,0 +1,38 @@
+-- Creates a family and its members in one round-trip / one transaction.
+-- Called from utils.create_family via supabase.rpc("create_family_with_members", ...).
+create or replace function public.create_family_with_members(
+    p_user uuid,
+    p_name text,
+    p_addr text,
+    p_income int,
+    p_scheme text,
+    p_card text,
+    p_members jsonb default '[]'::jsonb
+)
+returns jsonb
+language plpgsql
+as $$
+declare
+    fam families;
+    mems jsonb;
+begin
+    insert into families (user_id, family_name, address, annual_income, scheme_type, card_number)
+    values (p_user, p_name, p_addr, p_income, p_scheme, p_card)
+    returning * into fam;
+
+    -- each member: {name, relation, age}
+    with inserted as (
+        insert into family_members (family_id, name, relation, age)
+        select fam.id, m.name, m.relation, m.age
+        from jsonb_to_recordset(coalesce(p_members, '[]'::jsonb)) as m(name text, relation text, age int)
+        returning *
+    )
+    select coalesce(jsonb_agg(to_jsonb(inserted)), '[]'::jsonb) into mems from inserted;
+
+    return jsonb_build_object('family', to_jsonb(fam), 'members', mems);
+end;
+$$;
+
+-- server-side only: keep PostgREST from exposing it to anon/authenticated API keys
+revoke execute on function public.create_family_with_members(uuid, text, text, int, text, text, jsonb) from public, anon, authenticated;
+grant execute on function public.create_family_with_members(uuid, text, text, int, text, text, jsonb) to service_role;
@@ -1,167 +1,408 @@
 # utils.py
+import hashlib
 import os
-import uuid
-from dotenv import load_dotenv
-from supabase import create_client
-
-load_dotenv()  # read .env
-
-SUPABASE_URL = os.getenv("SUPABASE_URL")
-SUPABASE_SERVICE_ROLE_KEY = os.getenv("SUPABASE_SERVICE_ROLE_KEY")
-
-if not SUPABASE_URL or not SUPABASE_SERVICE_ROLE_KEY:
-    raise RuntimeError("Set SUPABASE_URL and SUPABASE_SERVICE_ROLE_KEY in your .env")
+import threading
+import time
+from typing import Any, Iterator
+import httpx
+import jwt
+import orjson
+from cachetools import TTLCache
+from postgrest.exceptions import APIError
+from supabase import ClientOptions, create_client
+from config import DATABASE_URL, SUPABASE_SERVICE_ROLE_KEY, SUPABASE_URL
+
+# One pooled, keep-alive HTTP/2 connection set shared by every Supabase call in this worker
+_http = httpx.Client(
+    http2=True,
+    limits=httpx.Limits(max_keepalive_connections=20, max_connections=50, keepalive_expiry=300),
+    timeout=httpx.Timeout(120.0),  # postgrest-py's own default; httpx's 5s would cut off slow RPCs/reads
+)
 
 # Create Supabase client using service role key (server-side)
-supabase = create_client(SUPABASE_URL, SUPABASE_SERVICE_ROLE_KEY)
+supabase = create_client(SUPABASE_URL, SUPABASE_SERVICE_ROLE_KEY,
+                         options=ClientOptions(httpx_client=_http))
+
+# Raw PostgREST access for hot paths that skip the supabase-py/postgrest-py layers
+_FAMILIES_URL = f"{SUPABASE_URL}/rest/v1/families"
+_REST_HEADERS = {
+    "apikey": SUPABASE_SERVICE_ROLE_KEY,
+    "Authorization": f"Bearer {SUPABASE_SERVICE_ROLE_KEY}",
+    "Accept": "application/json",
+}
+_REST_WRITE_HEADERS = {**_REST_HEADERS, "Content-Type": "application/json"}
+_CREATE_FAMILY_URL = f"{SUPABASE_URL}/rest/v1/rpc/create_family_with_members"
+
+# Validated access tokens: blake2b(token) -> (parsed user response, expires_at).
+# Lets require_auth skip the Supabase round-trip while the token is still live.
+_TOKEN_TTL = 300
+_token_cache: TTLCache[bytes, tuple[dict[str, Any], float]] = TTLCache(maxsize=10000, ttl=_TOKEN_TTL)
+_token_lock = threading.Lock()
+
+# Project signing keys, fetched once and reused so access tokens can be verified locally
+_JWKS = jwt.PyJWKClient(f"{SUPABASE_URL}/auth/v1/.well-known/jwks.json", cache_keys=True)
+_AUDIENCE = "authenticated"
+_JWKS_ALGORITHMS = ["RS256", "ES256"]
+
+# GET /families results per user_id. Short TTL bounds staleness across workers;
+# writes through this process drop the user's entry immediately.
+_FAMILIES_CACHE: TTLCache[str, dict[str, Any]] = TTLCache(maxsize=5000, ttl=10)
+# Bumped on every write per user_id; a read only fills the cache if no write happened
+# since it started, so an in-flight read can't put pre-write data back.
+_families_gen: dict[str, int] = {}
+_families_lock = threading.Lock()
+_FAMILIES_CACHE_MAX_BYTES = 1 << 20  # larger bodies are streamed but not kept
+
+_VALID_SCHEMES = frozenset(("Silver", "Gold", "Platinum"))
+
+# Families with more members than this go through COPY instead of the RPC
+_COPY_THRESHOLD = 50
+_pg_pool: Any = None
+if DATABASE_URL:
+    import psycopg
+    from psycopg.rows import dict_row
+    from psycopg_pool import ConnectionPool
+
+    # prepare_threshold=None: no server-side prepared statements (safe behind Supavisor)
+    _pg_pool = ConnectionPool(DATABASE_URL, min_size=1, max_size=10, open=True,
+                              kwargs={"row_factory": dict_row, "prepare_threshold": None})
+
+
+def _resp_data(resp: Any) -> dict[str, Any]:
+    """Helper to standardize postgrest (table / rpc) responses."""
+    return {"data": resp.data, "error": getattr(resp, "error", None)}
+
+
+def _error_message(e: Exception) -> str:
+    """Never empty, so callers can rely on {'error': ...} being truthy (str(httpx.PoolTimeout()) is '')."""
+    return str(e) or type(e).__name__
+
+
+def _http_failure(e: httpx.HTTPError) -> dict[str, Any]:
+    """Transport-level failure talking to Supabase: the service is unavailable, not the request bad."""
+    status = 503 if isinstance(e, httpx.PoolTimeout) else 504 if isinstance(e, httpx.TimeoutException) else 502
+    return {"error": _error_message(e), "status": status}
+
+
+def _rest_failure(resp: httpx.Response) -> dict[str, Any]:
+    """PostgREST error reply: 4xx is the request's fault (400), 5xx is upstream's (502)."""
+    return {"error": resp.text or f"HTTP {resp.status_code}", "status": 502 if resp.status_code >= 500 else 400}
+
+
+def _pg_failure(e: Exception) -> dict[str, Any]:
+    """Direct Postgres error: bad data is a 400, connection / pool trouble a 503, anything else a 500."""
+    if isinstance(e, psycopg.OperationalError):  # includes psycopg_pool.PoolTimeout
+        status = 503
+    elif isinstance(e, (psycopg.DataError, psycopg.IntegrityError)):
+        status = 400
+    else:
+        status = 500
+    return {"error": _error_message(e), "status": status}
 
 
-def _resp_data(resp):
-    """Helper to standardize supabase-py responses."""
-    # supabase-py response objects often have .data and .error attributes
-    try:
-        data = getattr(resp, "data", None)
-        error = getattr(resp, "error", None)
-        if data is not None or error is not None:
-            return {"data": data, "error": error}
-    except Exception:
-        pass
-    # fallback
-    try:
-        return dict(resp)
-    except Exception:
-        return {"raw": str(resp)}
+def _auth_data(resp: Any) -> dict[str, Any]:
+    """Helper to standardize gotrue (auth) responses, which are pydantic models without .data."""
+    return {"data": resp.model_dump(mode="json") if resp is not None else None, "error": None}
 
 
 ### AUTH helpers
 
-def register_user(email: str, password: str, user_metadata: dict | None = None):
+def register_user(email: str, password: str, user_metadata: dict | None = None) -> dict[str, Any]:
     """
     Register user via Supabase Auth.
     Returns supabase response (data / error).
     """
-    body = {"email": email, "password": password}
+    body: dict[str, Any] = {"email": email, "password": password}
     if user_metadata:
         # pass as options.data per supabase docs
         body["options"] = {"data": user_metadata}
-    resp = supabase.auth.sign_up(body)
-    return _resp_data(resp)
+    resp = supabase.auth.sign_up(body)  # type: ignore[arg-type]  # SDK wants its credentials TypedDict
+    return _auth_data(resp)
 
 
-def login_user(email: str, password: str):
+def login_user(email: str, password: str) -> dict[str, Any]:
     """
     Sign in user (email + password). Returns session & user details (if success).
     """
     resp = supabase.auth.sign_in_with_password({"email": email, "password": password})
-    return _resp_data(resp)
+    return _auth_data(resp)
 
 
-def send_password_reset(email: str, redirect_to: str | None = None):
+def send_password_reset(email: str, redirect_to: str | None = None) -> dict[str, Any]:
     """
     Send password reset email. 'redirect_to' optional.
     """
     if redirect_to:
-        resp = supabase.auth.reset_password_for_email(email, {"redirect_to": redirect_to})
+        supabase.auth.reset_password_for_email(email, {"redirect_to": redirect_to})
     else:
-        resp = supabase.auth.reset_password_for_email(email)
-    return _resp_data(resp)
+        supabase.auth.reset_password_for_email(email)
+    # the SDK returns nothing on success and raises on failure
+    return _auth_data(None)
+
+
+def _token_key(access_token: str) -> bytes:
+    return hashlib.blake2b(access_token.encode(), digest_size=16).digest()
 
 
-def get_user_from_token(access_token: str):
-    """Validate access token and return user object (or None)."""
+def _token_exp(access_token: str) -> float | None:
+    """Read the 'exp' claim without verifying (only used after Supabase accepted the token)."""
     try:
-        # supabase.auth.get_user accepts a JWT (access token)
-        resp = supabase.auth.get_user(access_token)
-        parsed = _resp_data(resp)
-        # parsed['data'] likely contains {'user': {...}} or directly user
-        return parsed
-    except Exception as e:
-        return {"error": str(e)}
+        return float(jwt.decode(access_token, options={"verify_signature": False})["exp"])
+    except (jwt.PyJWTError, KeyError, TypeError, ValueError):
+        return None
+
+
+def _user_result(user_id: str, email: str | None, role: str | None) -> dict[str, Any]:
+    """The one shape get_user_from_token returns on success: {'data': {'user': {...}}}."""
+    return {"data": {"user": {"id": user_id, "email": email, "role": role}}, "error": None}
+
+
+def _verify_token_locally(access_token: str) -> tuple[dict[str, Any], float]:
+    """Verify the JWT against the cached JWKS; raises jwt.PyJWTError if it can't be verified."""
+    # HS256 (legacy secret) tokens have no JWKS entry: skip the key fetch and go remote directly
+    if jwt.get_unverified_header(access_token).get("alg") not in _JWKS_ALGORITHMS:
+        raise jwt.InvalidAlgorithmError("token is not signed with a JWKS key")
+    signing_key = _JWKS.get_signing_key_from_jwt(access_token)
+    claims = jwt.decode(access_token, signing_key.key, algorithms=_JWKS_ALGORITHMS, audience=_AUDIENCE)
+    return _user_result(claims["sub"], claims.get("email"), claims.get("role")), float(claims["exp"])
+
+
+def get_user_from_token(access_token: str) -> dict[str, Any]:
+    """Validate access token; returns {'data': {'user': {'id', 'email', 'role'}}} or {'error': ...}."""
+    key = _token_key(access_token)
+    now = time.time()
+    with _token_lock:
+        cached = _token_cache.get(key)
+    if cached is not None and cached[1] > now:
+        return cached[0]
+
+    exp: float | None
+    try:
+        parsed, exp = _verify_token_locally(access_token)
+    except (jwt.PyJWTError, KeyError):
+        # e.g. legacy HS256 project (no JWKS) or key rotation: let Supabase decide
+        try:
+            # supabase.auth.get_user accepts a JWT (access token)
+            resp = supabase.auth.get_user(access_token)
+        except Exception as e:
+            return {"error": _error_message(e)}
+        user = resp.user if resp else None
+        if user is None:
+            return {"error": "Invalid token"}
+        parsed = _user_result(user.id, user.email, user.role)
+        exp = _token_exp(access_token)
+
+    if parsed.get("error") is None and exp and exp > now:
+        with _token_lock:
+            _token_cache[key] = (parsed, min(now + _TOKEN_TTL, exp))
+    return parsed
 
 
 ### FAMILY / MEMBER CRUD
 
-def _generate_card_number():
-    return f"CARD-{uuid.uuid4().hex[:10].upper()}"
+def _generate_card_number() -> str:
+    return "CARD-" + os.urandom(5).hex().upper()
+
+
+def _create_family_copy(user_id: str, family_name: str, address: str, annual_income: int,
+                        scheme: str, card_number: str, members: list[dict]) -> dict[str, Any]:
+    """Bulk path: insert the family, then COPY its members, in one direct Postgres transaction."""
+    with _pg_pool.connection() as conn:
+        family_record = conn.execute(
+            "insert into families (user_id, family_name, address, annual_income, scheme_type, card_number) "
+            "values (%s, %s, %s, %s, %s, %s) returning *",
+            (user_id, family_name, address, annual_income, scheme, card_number),
+        ).fetchone()
+        family_id = family_record["id"]
+        records = [(family_id, m.get("name"), m.get("relation"), m.get("age")) for m in members]
+        with conn.cursor() as cur:
+            with cur.copy("COPY family_members (family_id, name, relation, age) FROM STDIN") as copy:
+                for record in records:
+                    copy.write_row(record)
+        member_rows = conn.execute(
+            "select * from family_members where family_id = %s order by id", (family_id,)
+        ).fetchall()
+    return {"family": family_record, "members": member_rows}
 
 
 def create_family(user_id: str, family_name: str, address: str, annual_income: int,
-                  members: list[dict], chosen_scheme: str | None = None):
+                  members: list[dict], chosen_scheme: str | None = None) -> dict[str, Any]:
     """
-    Insert family and members. Applies business rule:
+    Insert family and members (single RPC round-trip). Applies business rule:
       - if annual_income < 100000 => scheme_type = 'Silver' (free)
       - else use chosen_scheme if provided, otherwise 'Silver'.
-    Returns created family record and inserted member records.
+    Returns created family record and inserted member records, or {'error', 'status'}
+    where status is 400 for rejected data and 5xx when Supabase / Postgres is unavailable.
     """
     # apply scheme logic
     if annual_income < 100000:
         scheme = "Silver"
     else:
-        scheme = chosen_scheme if chosen_scheme in ("Silver", "Gold", "Platinum") else "Silver"
+        scheme = chosen_scheme if chosen_scheme in _VALID_SCHEMES else "Silver"
 
     card_number = _generate_card_number()
-
-    # insert family
-    family_payload = {
-        "user_id": user_id,
-        "family_name": family_name,
-        "address": address,
-        "annual_income": annual_income,
-        "scheme_type": scheme,
-        "card_number": card_number,
+    res = _insert_family(user_id, family_name, address, annual_income, scheme, card_number, members)
+    _invalidate_families(user_id)
+    return res
+
+
+def _insert_family(user_id: str, family_name: str, address: str, annual_income: int,
+                   scheme: str, card_number: str, members: list[dict]) -> dict[str, Any]:
+    if _pg_pool is not None and len(members) > _COPY_THRESHOLD:
+        try:
+            return _create_family_copy(user_id, family_name, address, annual_income,
+                                       scheme, card_number, members)
+        except psycopg.Error as e:
+            return _pg_failure(e)
+
+    # insert family + members in one transaction (see sql/create_family_with_members.sql),
+    # posted straight to PostgREST on the pooled client rather than through supabase.rpc
+    payload = {
+        "p_user": user_id,
+        "p_name": family_name,
+        "p_addr": address,
+        "p_income": annual_income,
+        "p_scheme": scheme,
+        "p_card": card_number,
+        "p_members": members or [],  # each member dict: {name, relation, age}
     }
-    fam_resp = supabase.table("families").insert(family_payload).execute()
-    fam_parsed = _resp_data(fam_resp)
-    if fam_parsed.get("error"):
-        return {"error": fam_parsed["error"]}
-
-    # extract inserted family id
-    family_rows = fam_parsed.get("data")
-    if not family_rows:
-        return {"error": "Family insert returned no data."}
-    family_record = family_rows[0]
-    family_id = family_record.get("id")
-
-    # insert members if provided
-    member_rows = []
-    if members:
-        # each member dict: {name, relation, age}
-        to_insert = []
-        for m in members:
-            to_insert.append({
-                "family_id": family_id,
-                "name": m.get("name"),
-                "relation": m.get("relation"),
-                "age": m.get("age"),
-            })
-        mem_resp = supabase.table("family_members").insert(to_insert).execute()
-        mem_parsed = _resp_data(mem_resp)
-        if mem_parsed.get("error"):
-            return {"error": mem_parsed["error"]}
-        member_rows = mem_parsed.get("data")
+    try:
+        resp = _http.post(_CREATE_FAMILY_URL, content=orjson.dumps(payload), headers=_REST_WRITE_HEADERS)
+    except httpx.HTTPError as e:
+        return _http_failure(e)
+    if resp.is_error:
+        return _rest_failure(resp)
+
+    result = orjson.loads(resp.content)
+    if not result:
+        return {"error": "Family insert returned no data.", "status": 502}
+    return {"family": result["family"], "members": result["members"]}
+
+
+def _invalidate_families(user_id: str) -> None:
+    with _families_lock:
+        _families_gen[user_id] = _families_gen.get(user_id, 0) + 1
+        _FAMILIES_CACHE.pop(user_id, None)
+
+
+def _cache_families(user_id: str, gen: int, res: dict[str, Any]) -> None:
+    """Store a read result unless the user's families were written after the read began."""
+    with _families_lock:
+        if _families_gen.get(user_id, 0) == gen:
+            _FAMILIES_CACHE[user_id] = res
 
-    return {"family": family_record, "members": member_rows}
 
+# Same shape as the PostgREST "*, family_members(*)" select, in one direct query.
+# Postgres renders the whole array as text, so it is never parsed on our side.
+_FAMILIES_SQL = (
+    "select coalesce(json_agg(t), '[]')::text as families from ("
+    "select f.*, coalesce(json_agg(fm order by fm.id) filter (where fm.id is not null), '[]') "
+    "as family_members "
+    "from families f left join family_members fm on fm.family_id = f.id "
+    "where f.user_id = %s group by f.id order by f.id) t"
+)
 
-def get_families_for_user(user_id: str):
+
+def _get_families_direct(user_id: str) -> dict[str, Any]:
+    """Read path over the direct Postgres pool, skipping PostgREST's HTTP/JSON hop."""
+    try:
+        with _pg_pool.connection() as conn:
+            row = conn.execute(_FAMILIES_SQL, (user_id,)).fetchone()
+    except psycopg.Error as e:
+        return {"error": _error_message(e)}
+    return {"data": row["families"].encode(), "error": None}
+
+
+def _get_families_rest(user_id: str, gen: int) -> dict[str, Any]:
     """
-    Return families with nested members for the user.
-    Uses a referenced select: "*, family_members(*)"
+    Open the PostgREST select as a byte stream instead of letting postgrest-py buffer and parse it.
+    The status is checked before returning, so errors still come back as {'error': ...}.
+    The caller must invoke 'close' once the response is done.
     """
-    resp = supabase.table("families").select("*, family_members(*)").eq("user_id", user_id).execute()
+    request = _http.build_request("GET", _FAMILIES_URL, headers=_REST_HEADERS,
+                                  params={"select": "*,family_members(*)", "user_id": f"eq.{user_id}"})
+    try:
+        resp = _http.send(request, stream=True)
+    except httpx.HTTPError as e:
+        return {"error": _error_message(e)}
+    if resp.is_error:
+        resp.read()
+        resp.close()
+        return {"error": resp.text or f"HTTP {resp.status_code}"}
+    # 'close' releases the upstream connection even if the stream is never iterated (HEAD, early disconnect)
+    return {"stream": _tee_families(user_id, gen, resp), "close": resp.close, "error": None}
+
+
+def _tee_families(user_id: str, gen: int, resp: httpx.Response) -> Iterator[bytes]:
+    """Yield the body as it arrives; cache it once fully sent, unless it is too large to keep."""
+    chunks: list[bytes] | None = []
+    size = 0
+    try:
+        for chunk in resp.iter_bytes():
+            if chunks is not None:
+                size += len(chunk)
+                if size <= _FAMILIES_CACHE_MAX_BYTES:
+                    chunks.append(chunk)
+                else:
+                    chunks = None
+            yield chunk
+    finally:
+        resp.close()
+    if chunks is not None:
+        _cache_families(user_id, gen, {"data": b"".join(chunks), "error": None})
+
+
+def get_families_for_user(user_id: str) -> dict[str, Any]:
+    """
+    Return families with nested members for the user (cached for a few seconds).
+    Uses a referenced select: "*, family_members(*)" (or the equivalent join when DATABASE_URL is set)
+    The JSON array is never decoded: 'data' holds it as bytes (cache hit / direct query), or
+    'stream' yields it chunk by chunk straight from PostgREST.
+    """
+    with _families_lock:
+        cached = _FAMILIES_CACHE.get(user_id)
+        gen = _families_gen.get(user_id, 0)
+    if cached is not None:
+        return cached
+    if _pg_pool is None:
+        return _get_families_rest(user_id, gen)  # cached by _tee_families once streamed
+    res = _get_families_direct(user_id)
+    if res.get("error") is None:
+        _cache_families(user_id, gen, res)
+    return res
+
+
+def update_family(user_id: str, family_id: int, updates: dict) -> dict[str, Any]:
+    resp = supabase.table("families").update(updates).eq("id", family_id).execute()
+    _invalidate_families(user_id)
     return _resp_data(resp)
 
 
-def update_family(family_id: int, updates: dict):
-    resp = supabase.table("families").update(updates).eq("id", family_id).execute()
+def update_member(user_id: str, member_id: int, updates: dict) -> dict[str, Any]:
+    resp = supabase.table("family_members").update(updates).eq("id", member_id).execute()
+    _invalidate_families(user_id)
     return _resp_data(resp)
 
 
-def update_member(member_id: int, updates: dict):
-    resp = supabase.table("family_members").update(updates).eq("id", member_id).execute()
+def bulk_update_members(user_id: str, items: list[dict]) -> dict[str, Any]:
+    """
+    Apply [{id, updates: {name?, relation?, age?}}, ...] in a single RPC round-trip
+    (see sql/bulk_update_members.sql). Only members of user_id's families are updated;
+    returns the updated member rows.
+    """
+    payload = [{**item.get("updates", {}), "id": item["id"]} for item in items]
+    try:
+        resp = supabase.rpc("bulk_update_members", {"p_user": user_id, "payload": payload}).execute()
+    except APIError as e:
+        # PostgREST rejected the payload (e.g. a value out of range for its column)
+        return {"error": e.message or _error_message(e), "status": 400}
+    except httpx.HTTPError as e:
+        return _http_failure(e)
+    _invalidate_families(user_id)
     return _resp_data(resp)
 
 
-def delete_member(member_id: int):
+def delete_member(user_id: str, member_id: int) -> dict[str, Any]:
     resp = supabase.table("family_members").delete().eq("id", member_id).execute()
+    _invalidate_families(user_id)
     return _resp_data(resp)